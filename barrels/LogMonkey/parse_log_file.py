@@ -1,53 +1,99 @@
 #
 # This script will parse and output a filtered version
 # of a given log file generated by the LogMonkey Connect
-# IQ Monkey Barrel. See the print_help() function for details.
+# IQ Monkey Barrel. See the create_argument_parser() function
+# or run the script with -h for details.
 #
 
-import getopt
+import argparse
+import csv
+import itertools
+import mmap
+import multiprocessing
 import sys
 import re
-import os.path
+import os
 
-LOG_FILE_OUTPUT_FORMAT = "({0})[{1}] {{{2}}} {3}: {4}"
-CSV_FILE_OUTPUT_FORMAT = "{0},{1},{2},{3}"
-LOG_LINE_PATTERN = re.compile("^\(lmf([0-9])+\)\[[0-9: -]{19}\] \{\\w+\} [^:]+: .*$")
-LOG_LEVEL_WIDTH = 0
-TAG_WIDTH = 0
+# Encoding of the log files and the output. Bytes that aren't valid
+# UTF-8 are carried through as surrogates so they are written back out
+# unchanged.
+LOG_FILE_ENCODING = "utf-8"
+LOG_FILE_ERRORS = "surrogateescape"
+# The pattern of a valid log line, split around the log level so a
+# log level filter can be compiled into it. The blocks of a line are
+# separated by single spaces and the tag ends with ": ", the tag and
+# message groups leave out any further surrounding whitespace. A tag of
+# only whitespace is allowed and parses as an empty tag. The pattern is
+# run over the raw bytes of a whole file, so it only allows whitespace
+# other than newlines ([^\S\n]) to keep a match from running into the
+# next line.
+LOG_LINE_PATTERN_PREFIX = rb"^\((?P<fmt>lmf\d+)\)\[(?P<ts>[0-9: -]{19})\] \{(?P<lvl>"
+LOG_LINE_PATTERN_SUFFIX = rb")\} (?=[^:\n])[^\S\n]*(?P<tag>(?:[^:\s]+(?:[^\S\n]+[^:\s]+)*)?)[^\S\n]*: [^\S\n]*(?P<msg>(?:.*\S)?)[^\S\n]*$"
+LOG_LEVEL_PATTERN = rb"\w+"
+LOG_LINE_PATTERN = re.compile(LOG_LINE_PATTERN_PREFIX + LOG_LEVEL_PATTERN + LOG_LINE_PATTERN_SUFFIX, re.MULTILINE)
 
 #
-# Prints a help message for this script
+# Checks that the given input path is an existing file
 #
-def print_help():
-    print '''
+# @param path The input path given on the command line
+# @return The validated path
+#
+def input_file_path(path):
+    if not os.path.isfile(path):
+        raise argparse.ArgumentTypeError("Path isn't valid: " + path)
+    return path
+
+#
+# Parses the tag filter option into the set of tags to filter on
+#
+# @param arg The comma separated tag values given on the command line
+# @return The tag values as a frozenset
+#
+def tag_filter(arg):
+    return frozenset(arg.split(","))
+
+#
+# Creates the parser for the command line arguments of this script
+#
+# @return The argparse.ArgumentParser for this script
+#
+def create_argument_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''
 Main Page:
     https://github.com/garmin/connectiq-apps/tree/master/barrels/LogMonkey
 Description:
     This script takes log files generated by the LogMonkey Connect
     IQ Monkey Barrel as input, parses them and then outputs the parsed
-    content.
-Arguments:
-    Pass a list of log files to parse:
-    log_file1.txt log_file2.txt
-Options:
-    '-l logLevel'   : The log level to filter on.
-    '-t tag_values' : The tag value(s) to filter on. Values should be separated by
-                      commas. Tag values with a space should be wrapped in quotes.
-    '-o output_file': The file to write output to instead of standard out. The values
-                      will be output in the same (potentially formatted) output format
-                      unless the provided file is a .csv file in which case the fields
-                      will be csv formatted.
-    '-s'            : If this flag is set the output format will make the columns spacing
-                      equivalent throughout the file.
-    '-h'            : Prints this message.
+    content.''',
+        epilog='''
 Example:
-    python parse_log_file -l D -t tag myLog.txt
-    '''
+    python parse_log_file.py -l D -t tag myLog.txt''')
+    parser.add_argument("-l", dest="logLevel", metavar="logLevel",
+                        help="The log level to filter on.")
+    parser.add_argument("-t", dest="tagFilter", metavar="tag_values", type=tag_filter,
+                        help="The tag value(s) to filter on. Values should be separated by "
+                             "commas. Tag values with a space should be wrapped in quotes.")
+    parser.add_argument("-o", dest="outputFile", metavar="output_file",
+                        help="The file to write output to instead of standard out. The values "
+                             "will be output in the same (potentially formatted) output format "
+                             "unless the provided file is a .csv file in which case the fields "
+                             "will be csv formatted.")
+    parser.add_argument("-s", dest="spaceColumns", action="store_true",
+                        help="If this flag is set the output format will make the columns "
+                             "spacing equivalent throughout the file.")
+    parser.add_argument("inputPaths", metavar="log_file", nargs="+", type=input_file_path,
+                        help="A log file to parse.")
+    return parser
 
 #
 # A class which holds information about a line in a log file.
 #
 class LogLine:
+    # Slots keep each instance free of a __dict__, which matters when
+    # holding every line of a big log file for spaced output
+    __slots__ = ("rawValue", "logFormat", "timestamp", "logLevel", "tag", "message")
 
     #
     # Creates a new LogLine object.
@@ -71,145 +117,146 @@ class LogLine:
         return self.rawValue.strip()
 
     #
-    # Checks if this line matches the given log level and tag filters
+    # Returns the raw log line as it should be output
     #
-    # @param logLevel The log level we're filtering for
-    # @param tagFilter The tag(s) we're looking for
-    # @return True if the line matches the given log level and tag(s)
+    # @return The raw log line ending with a newline
     #
-    def matches_filters(self, logLevel, tagFilter):
-        # Check against the log level first
-        if logLevel is not None and logLevel != self.logLevel:
-            return False
-
-        # Check against the tag filter list
-        if tagFilter is not None and self.tag not in tagFilter:
-            return False
-
-        # By default the log level will match
-        return True
+    def to_raw_string(self):
+        return self.rawValue.strip() + "\n"
 
     #
     # Returns a formatted line that conforms to the given width values
     #
     # @param logLevelWidth The number of characters wide the log level value should be
     # @param tagWidth The number of characters wide the tag value should be
-    # @return A formatted log line
+    # @return A formatted log line ending with a newline
     #
     def to_spaced_string(self, logLevelWidth, tagWidth):
-        formattedLogFormat = self.logFormat
-        formattedTimestamp = self.timestamp
-        formattedLogLevel = ("{:<" + str(logLevelWidth) + "}").format(self.logLevel)
-        formattedTag = ("{:<" + str(tagWidth) + "}").format(self.tag)
-        formattedMessage = self.message
-        return LOG_FILE_OUTPUT_FORMAT.format(formattedLogFormat, formattedTimestamp, formattedLogLevel, formattedTag, formattedMessage)
+        return f"({self.logFormat})[{self.timestamp}] {{{self.logLevel.ljust(logLevelWidth)}}} {self.tag.ljust(tagWidth)}: {self.message}\n"
 
     #
-    # Returns the log line formatted as CSV format
+    # Returns the fields of the log line as a CSV row
     #
-    # @return The log line formatted to a CSV entry
+    # @return The row to pass to a csv.writer
     #
-    def to_csv_string(self):
-        formattedTimestamp = self.timestamp
-        if "," in formattedTimestamp:
-            formattedTimestamp = "\"" + formattedTimestamp + "\""
-        formattedLogLevel = self.logLevel
-        if "," in formattedLogLevel:
-            formattedLogLevel = "\"" + formattedLogLevel + "\""
-        formattedTag = self.tag
-        if "," in formattedTag:
-            formattedTag = "\"" + formattedTag + "\""
-        formattedMessage = self.message
-        if "," in formattedMessage:
-            formattedMessage = "\"" + formattedMessage + "\""
-        return CSV_FILE_OUTPUT_FORMAT.format(formattedTimestamp, formattedLogLevel, formattedTag, formattedMessage);
+    def to_csv_row(self):
+        return (self.timestamp, self.logLevel, self.tag, self.message)
 
-    #
-    # Outputs the given LogLine. If the given output file isn't None
-    # the line will be printed to that file or else it will be printed
-    # to standard output.
-    #
-    # @param outputFile The output file to write the log line tobytes
-    # @param spaceColumns True if the columns should be uniformly spaced
-    #
-    def output_log_line(self, outputFile, spaceColumns):
-        if outputFile is not None:
-            if os.path.splitext(outputFile.name)[1][1:] == "csv":
-                outputFile.write(self.to_csv_string())
-            elif spaceColumns:
-                outputFile.write(self.to_spaced_string(LOG_LEVEL_WIDTH, TAG_WIDTH))
-            else:
-                outputFile.write(str(self))
-            outputFile.write("\n")
-        else:
-            if spaceColumns:
-                print self.to_spaced_string(LOG_LEVEL_WIDTH, TAG_WIDTH)
-            else:
-                print str(self)
+#
+# Returns the pattern that matches the valid log lines with the given
+# log level. Filtering on the log level inside the pattern lets the
+# regex engine reject other lines before any of their fields are
+# extracted.
+#
+# @param logLevel The log level we're looking for
+# @return The compiled log line pattern
+#
+def get_line_pattern(logLevel):
+    if logLevel is None:
+        return LOG_LINE_PATTERN
+    # A log level that isn't valid can't match any line
+    level = logLevel.encode(LOG_FILE_ENCODING, LOG_FILE_ERRORS)
+    if re.fullmatch(LOG_LEVEL_PATTERN, level) is None:
+        return re.compile(rb"(?!)")
+    return re.compile(LOG_LINE_PATTERN_PREFIX + re.escape(level) + LOG_LINE_PATTERN_SUFFIX, re.MULTILINE)
+
+#
+# Writes the given log lines to the output file
+#
+# @param outputFile The file to write the log lines to
+# @param logLines The LogLine objects to write
+# @param formatLine The function that turns a LogLine into an output line
+#
+def write_log_lines(outputFile, logLines, formatLine):
+    outputFile.writelines(formatLine(line) for line in logLines)
+
+#
+# Writes the given log lines to the output file as CSV rows
+#
+# @param outputFile The file to write the log lines to
+# @param logLines The LogLine objects to write
+#
+def write_csv_lines(outputFile, logLines):
+    writeRow = csv.writer(outputFile, lineterminator="\n").writerow
+    for line in logLines:
+        writeRow(line.to_csv_row())
 
 #
 # Reads through the given input file and parses the lines that are
-# valid LogMonkey log lines.
+# valid LogMonkey log lines. The file is memory mapped and searched as
+# a whole, only the fields of the lines that pass the filters are
+# decoded.
 #
 # @param path The path to the input log file to read
 # @param logLevel The log level we're looking for
 # @param tagFilter The tag(s) we're looking for
-# @return A list of LogLine objects read from the file
+# @return A generator of the LogLine objects read from the file
 #
 def read_through_input_file(path, logLevel, tagFilter):
-    logLines = []
-    global LOG_LEVEL_WIDTH
-    global TAG_WIDTH
-    with open(path) as input:
-        for line in input:
-            # Check to make sure the line is a valid log entry
-            if LOG_LINE_PATTERN.match(line):
-                logLine = parse_log_line(line)
+    # Bind the names used for every line to locals up front
+    findLines = get_line_pattern(logLevel).finditer
+    createLogLine = LogLine
+
+    # The tags are compared before they are decoded
+    if tagFilter is not None:
+        tagFilter = frozenset(tag.encode(LOG_FILE_ENCODING, LOG_FILE_ERRORS) for tag in tagFilter)
 
-                # Check the line against the filter options. If the line matches
-                # the filter options then output the line
-                if logLine.matches_filters(logLevel, tagFilter):
-                    logLines.append(logLine)
+    with open(path, "rb") as input:
+        # Empty files can't be memory mapped
+        if os.fstat(input.fileno()).st_size == 0:
+            return
 
-                    # Check if we need to update the log level or tag width
-                    if len(logLine.logLevel) > LOG_LEVEL_WIDTH:
-                        LOG_LEVEL_WIDTH = len(logLine.logLevel)
-                    if len(logLine.tag) > TAG_WIDTH:
-                        TAG_WIDTH = len(logLine.tag)
-    return logLines
+        with mmap.mmap(input.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for match in findLines(data):
+                # The log level was already filtered on by the pattern, check
+                # the tag before decoding the fields and creating the LogLine
+                if tagFilter is not None and match.group("tag") not in tagFilter:
+                    continue
+
+                yield createLogLine(*[field.decode(LOG_FILE_ENCODING, LOG_FILE_ERRORS)
+                                      for field in match.group(0, "fmt", "ts", "lvl", "tag", "msg")])
 
 #
-# Parses the given raw log line into a LogLine object
+# Reads through the given input file in a worker process. The parsed
+# lines are returned as tuples of their fields so they can be sent back
+# to the main process.
 #
-# @param line The raw log line to parse
-# @return The LogLine object which represents the given log line
+# @param args The path, log level and tag filter to pass on to
+#             read_through_input_file()
+# @return A list with the fields of each parsed LogLine
 #
-def parse_log_line(line):
-    # The log format is wrapped in parenthesis
-    startIndex = line.find("(")+1
-    endIndex = line.find(")", startIndex)
-    logFormat = line[startIndex:endIndex]
-
-    # The timestamp is wrapped in square brackets
-    startIndex = line.find("[")+1
-    endIndex = line.find("]", startIndex)
-    timestamp = line[startIndex:endIndex]
-
-    # The log level is wrapped in curly brackets
-    startIndex = line.find("{", endIndex)+1
-    endIndex = line.find("}", startIndex)
-    logLevel = line[startIndex:endIndex]
+def parse_input_file(args):
+    path, logLevel, tagFilter = args
+    return [(line.rawValue, line.logFormat, line.timestamp, line.logLevel, line.tag, line.message)
+            for line in read_through_input_file(path, logLevel, tagFilter)]
 
-    # The tag follows the log level and ends with a colon
-    startIndex = endIndex+1
-    endIndex = line.find(":", startIndex)
-    tag = line[startIndex:endIndex].strip()
-
-    # The message is the rest of the line
-    startIndex = endIndex+1
-    message = line[startIndex:].strip()
+#
+# Reads through all of the given input files. When there is more than
+# one file they are parsed in parallel by a pool of worker processes,
+# the lines are still returned in the order of the input files.
+#
+# @param paths The paths to the input log files to read
+# @param logLevel The log level we're looking for
+# @param tagFilter The tag(s) we're looking for
+# @return A generator of the LogLine objects read from the files
+#
+def read_through_input_files(paths, logLevel, tagFilter):
+    if len(paths) < 2:
+        for path in paths:
+            for line in read_through_input_file(path, logLevel, tagFilter):
+                yield line
+        return
 
-    return LogLine(line, logFormat, timestamp, logLevel, tag, message)
+    createLogLine = LogLine
+    pool = multiprocessing.Pool(min(len(paths), multiprocessing.cpu_count()))
+    try:
+        parsedFiles = pool.imap(parse_input_file, [(path, logLevel, tagFilter) for path in paths])
+        for fields in itertools.chain.from_iterable(parsedFiles):
+            yield createLogLine(*fields)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
 
 #
 # The main function of the script. This function will parse the
@@ -217,66 +264,44 @@ def parse_log_line(line):
 # generate the filtered output.
 #
 def main():
-    # These are the local variables we need to populate from the
-    # command line arguments/options.
-    inputPaths = None
-    outputFile = None
-    tagFilter = None
-    logLevel = None
-    spaceColumns = False
-
-    # Check argument list
-    try:
-        optlist, args = getopt.getopt(sys.argv[1:], 'o:l:t:sh')
-
-        # Get the input files from the argument list
-        inputPaths = args
-
-        # Make sure at least one input path value was provided
-        if inputPaths is None:
-            print "No input path(s) provided"
-            exit(2)
-        else:
-            # Make sure all of the provided input paths are valid
-            for path in inputPaths:
-                if not os.path.isfile(path):
-                    print "Path isn't valid: " + path
-                    exit(3)
-
-        # Go through the option values
-        for option, arg in optlist:
-            if option == "-o":
-                outputFile = arg
-            elif option == "-l":
-                logLevel = arg
-            elif option == "-t":
-                tagFilter = arg.split(",")
-            elif option == "-s":
-                spaceColumns = True
-            elif option == "-h":
-                print_help()
-                exit(0)
+    # Parse the command line arguments. If there is a problem with them
+    # the parser prints the usage and exits.
+    args = create_argument_parser().parse_args()
+    inputPaths = args.inputPaths
+    outputFile = args.outputFile
+    tagFilter = args.tagFilter
+    logLevel = args.logLevel
+    spaceColumns = args.spaceColumns
 
-    # If there was a problem processing the arguments to the script
-    # then exit here.
-    except getopt.GetoptError as err:
-        print(err)
-        print_help()
-        exit(1)
+    # Read through each of the input files and parse the log entries. The
+    # entries are streamed straight to the output unless the columns need
+    # to be spaced, in which case all of them have to be read first so the
+    # column widths are known.
+    logLines = read_through_input_files(inputPaths, logLevel, tagFilter)
 
-    # Read through each of the input files and parse the log entries
-    logLines = []
-    for path in inputPaths:
-        logLines = list(logLines + read_through_input_file(path, logLevel, tagFilter))
+    # Work out the output format once for the whole run. CSV output
+    # ignores the column spacing.
+    csvOutput = outputFile is not None and os.path.splitext(outputFile)[1][1:] == "csv"
+    formatLine = LogLine.to_raw_string
+    if spaceColumns and not csvOutput:
+        logLines = list(logLines)
+        logLevelWidth = 0
+        tagWidth = 0
+        if logLines:
+            logLevelWidth = max(len(line.logLevel) for line in logLines)
+            tagWidth = max(len(line.tag) for line in logLines)
+        formatLine = lambda line: line.to_spaced_string(logLevelWidth, tagWidth)
 
     # Output to file if one was provided
-    if outputFile is not None:
-        with open(outputFile, "w") as file:
-            for line in logLines:
-                line.output_log_line(file, spaceColumns)
+    if csvOutput:
+        with open(outputFile, "w", encoding=LOG_FILE_ENCODING, errors=LOG_FILE_ERRORS, newline="") as file:
+            write_csv_lines(file, logLines)
+    elif outputFile is not None:
+        with open(outputFile, "w", encoding=LOG_FILE_ENCODING, errors=LOG_FILE_ERRORS) as file:
+            write_log_lines(file, logLines, formatLine)
     else:
-        for line in logLines:
-            line.output_log_line(None, spaceColumns)
+        sys.stdout.reconfigure(encoding=LOG_FILE_ENCODING, errors=LOG_FILE_ERRORS)
+        write_log_lines(sys.stdout, logLines, formatLine)
 
 if __name__ == '__main__':
     main()